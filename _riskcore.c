@@ -0,0 +1,112 @@
+/*
+ * C version of the Risk dice simulator battle loop.
+ * Written by The Static Mage
+ * https://github.com/thestaticmage/risk-dice-analysis
+ *
+ * Simulates a whole batch of battles per call, with no JIT or interpreter
+ * overhead. Build it next to risk-dice-simulator.py with:
+ * python setup.py build_ext --inplace
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+
+#include "_xoshiro.h"
+
+#define MAX_ATTACKERS 3
+
+/* Number of possible rolls for a given total number of dice. */
+static const uint64_t OUTCOMES[7] = {1, 6, 36, 216, 1296, 7776, 46656};
+
+static PyObject *simulate_batch(PyObject *self, PyObject *args)
+{
+    int attacking_troops, defending_troops, max_defenders;
+    unsigned long long seed;
+    Py_buffer offsets_buffer, losses_buffer, battles_buffer;
+
+    if (!PyArg_ParseTuple(args, "iiiy*y*Kw*", &attacking_troops, &defending_troops, &max_defenders,
+                          &offsets_buffer, &losses_buffer, &seed, &battles_buffer)) {
+        return NULL;
+    }
+
+    if (offsets_buffer.len != 16 * sizeof(int64_t) || battles_buffer.len % (4 * sizeof(int64_t)) != 0) {
+        PyErr_SetString(PyExc_ValueError, "offsets must be 4x4 int64 and battles must have 4 int64 columns");
+        PyBuffer_Release(&offsets_buffer);
+        PyBuffer_Release(&losses_buffer);
+        PyBuffer_Release(&battles_buffer);
+        return NULL;
+    }
+
+    const int64_t *offsets = offsets_buffer.buf;
+    const uint8_t *losses = losses_buffer.buf;
+
+    /* Make sure every table the battle loop can index lies inside losses. */
+    int valid = max_defenders >= 1 && max_defenders <= 3;
+    for (int attackers = 1; valid && attackers <= MAX_ATTACKERS; attackers++) {
+        for (int defenders = 1; valid && defenders <= max_defenders; defenders++) {
+            int64_t offset = offsets[attackers * 4 + defenders];
+            valid = offset >= 0 && (uint64_t)offset + OUTCOMES[attackers + defenders] <= (uint64_t)losses_buffer.len;
+        }
+    }
+    if (!valid) {
+        PyErr_SetString(PyExc_ValueError, "max_defenders must be 1 to 3 and losses must cover every table in offsets");
+        PyBuffer_Release(&offsets_buffer);
+        PyBuffer_Release(&losses_buffer);
+        PyBuffer_Release(&battles_buffer);
+        return NULL;
+    }
+
+    int64_t *battles = battles_buffer.buf;
+    Py_ssize_t trials = battles_buffer.len / (4 * sizeof(int64_t));
+    uint64_t state[4];
+
+    Py_BEGIN_ALLOW_THREADS
+    seed_random(state, seed);
+    for (Py_ssize_t trial = 0; trial < trials; trial++) {
+        int attackers_left = attacking_troops, defenders_left = defending_troops;
+        int64_t maximum_rolls = 0, non_maximum_rolls = 0;
+
+        while (attackers_left > 1 && defenders_left > 0) {
+            int attackers = attackers_left - 1 < MAX_ATTACKERS ? attackers_left - 1 : MAX_ATTACKERS;
+            int defenders = defenders_left < max_defenders ? defenders_left : max_defenders;
+            uint8_t outcome = losses[offsets[attackers * 4 + defenders] + next_random(state) % OUTCOMES[attackers + defenders]];
+            attackers_left -= outcome >> 4;
+            defenders_left -= outcome & 0xF;
+            if (attackers == MAX_ATTACKERS && defenders == max_defenders) {
+                maximum_rolls++;
+            } else {
+                non_maximum_rolls++;
+            }
+        }
+
+        battles[trial * 4] = attacking_troops - attackers_left;
+        battles[trial * 4 + 1] = defending_troops - defenders_left;
+        battles[trial * 4 + 2] = maximum_rolls;
+        battles[trial * 4 + 3] = non_maximum_rolls;
+    }
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&offsets_buffer);
+    PyBuffer_Release(&losses_buffer);
+    PyBuffer_Release(&battles_buffer);
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef riskcore_methods[] = {
+    {"simulate_batch", simulate_batch, METH_VARARGS,
+     "simulate_batch(attacking_troops, defending_troops, max_defenders, offsets, losses, seed, battles)\n\n"
+     "Simulate one battle per row of battles, an int64 array with 4 columns, storing the attacker\n"
+     "losses, defender losses, number of maximum rolls and number of non-maximum rolls. offsets\n"
+     "and losses are the precomputed tables from risk-dice-simulator.py."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef riskcore_module = {
+    PyModuleDef_HEAD_INIT, "_riskcore", "C version of the Risk dice simulator battle loop.", -1, riskcore_methods
+};
+
+PyMODINIT_FUNC PyInit__riskcore(void)
+{
+    return PyModule_Create(&riskcore_module);
+}
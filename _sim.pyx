@@ -0,0 +1,76 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+"""
+Ahead-of-time compiled version of the Risk dice simulator battle loop.
+Written by The Static Mage
+https://github.com/thestaticmage/risk-dice-analysis
+
+This simulates a whole batch of battles per call on a single core, and is only
+used when risk-dice-simulator.py is run with --cython. Like the C battle loop
+in _riskcore.c it only replaces the battle loop: the precomputed tables are
+still built with Numba. Build it next to risk-dice-simulator.py with:
+python setup.py build_ext --inplace
+"""
+
+from libc.stdint cimport int64_t, uint64_t
+
+cdef enum:
+    MAX_ATTACKERS = 3
+
+# Number of possible rolls for a given total number of dice.
+cdef uint64_t _OUTCOMES[7]
+_OUTCOMES[:] = [1, 6, 36, 216, 1296, 7776, 46656]
+
+
+cdef extern from "_xoshiro.h":
+    uint64_t next_random(uint64_t *s) noexcept nogil
+    void seed_random(uint64_t *s, uint64_t seed) noexcept nogil
+
+
+def simulate_batch(int attacking_troops, int defending_troops, int max_defenders,
+                   const int64_t[:, ::1] precomp_offsets, const unsigned char[::1] precomp_losses,
+                   uint64_t seed, int64_t[:, ::1] battles):
+    """
+    Same arguments as simulate_batch() in _riskcore.c: simulate one battle per
+    row of battles, storing the attacker losses, defender losses, number of
+    maximum rolls and number of non-maximum rolls.
+    """
+    if precomp_offsets.shape[0] != 4 or precomp_offsets.shape[1] != 4 or battles.shape[1] != 4:
+        raise ValueError("offsets must be 4x4 int64 and battles must have 4 int64 columns")
+    if not 1 <= max_defenders <= 3:
+        raise ValueError("max_defenders must be 1 to 3")
+    cdef int attackers, defenders
+    for attackers in range(1, MAX_ATTACKERS + 1):
+        for defenders in range(1, max_defenders + 1):
+            if (precomp_offsets[attackers, defenders] < 0 or
+                    precomp_offsets[attackers, defenders] + <int64_t>_OUTCOMES[attackers + defenders] > precomp_losses.shape[0]):
+                raise ValueError("losses must cover every table in offsets")
+
+    cdef uint64_t state[4]
+    cdef Py_ssize_t trial
+    cdef int attackers_left, defenders_left
+    cdef int64_t maximum_rolls, non_maximum_rolls
+    cdef unsigned char outcome
+
+    with nogil:
+        seed_random(state, seed)
+        for trial in range(battles.shape[0]):
+            attackers_left = attacking_troops
+            defenders_left = defending_troops
+            maximum_rolls = 0
+            non_maximum_rolls = 0
+
+            while attackers_left > 1 and defenders_left > 0:
+                attackers = min(attackers_left - 1, MAX_ATTACKERS)
+                defenders = min(defenders_left, max_defenders)
+                outcome = precomp_losses[precomp_offsets[attackers, defenders] + <int64_t>(next_random(state) % _OUTCOMES[attackers + defenders])]
+                attackers_left -= outcome >> 4
+                defenders_left -= outcome & 0xF
+                if attackers == MAX_ATTACKERS and defenders == max_defenders:
+                    maximum_rolls += 1
+                else:
+                    non_maximum_rolls += 1
+
+            battles[trial, 0] = attacking_troops - attackers_left
+            battles[trial, 1] = defending_troops - defenders_left
+            battles[trial, 2] = maximum_rolls
+            battles[trial, 3] = non_maximum_rolls
@@ -0,0 +1,47 @@
+/*
+ * Random number generator shared by _riskcore.c and _sim.pyx.
+ * Written by The Static Mage
+ * https://github.com/thestaticmage/risk-dice-analysis
+ *
+ * This is the same xoshiro256** generator, seeded the same way, as
+ * _next_random() and _random_state() in risk-dice-simulator.py, so every
+ * battle loop draws from the same generator.
+ */
+
+#ifndef RISK_XOSHIRO_H
+#define RISK_XOSHIRO_H
+
+#include <stdint.h>
+
+static inline uint64_t rotl(uint64_t x, int k)
+{
+    return (x << k) | (x >> (64 - k));
+}
+
+/* xoshiro256** by David Blackman and Sebastiano Vigna. */
+static inline uint64_t next_random(uint64_t *s)
+{
+    uint64_t result = rotl(s[1] * 5, 7) * 9;
+    uint64_t t = s[1] << 17;
+    s[2] ^= s[0];
+    s[3] ^= s[1];
+    s[1] ^= s[2];
+    s[0] ^= s[3];
+    s[2] ^= t;
+    s[3] = rotl(s[3], 45);
+    return result;
+}
+
+/* Expand a seed into the full generator state with SplitMix64, as
+ * recommended by the xoshiro authors. */
+static inline void seed_random(uint64_t *s, uint64_t seed)
+{
+    for (int i = 0; i < 4; i++) {
+        uint64_t z = (seed += 0x9E3779B97F4A7C15ULL);
+        z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+        z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+        s[i] = z ^ (z >> 31);
+    }
+}
+
+#endif
@@ -7,8 +7,9 @@ https://github.com/thestaticmage/risk-dice-analysis
 """
 
 import argparse
-from collections import defaultdict
-from os.path import basename
+
+import numpy as np
+import pandas as pd
 
 DEBUG = False
 
@@ -17,12 +18,31 @@ def debug_print(message):
         print(message)
 
 
+def update_statistics(count, mean, m2, values):
+    """
+    Fold a chunk of values into the running count, mean and sum of squared
+    differences from the mean. This is the parallel form of Welford's
+    algorithm, which avoids the cancellation error of computing the variance
+    as E[X^2] - E[X]^2.
+    """
+    chunk_count = values.size
+    chunk_mean = values.mean()
+    chunk_m2 = np.square(values - chunk_mean).sum()
+
+    total = count + chunk_count
+    delta = chunk_mean - mean
+    mean += delta * chunk_count / total
+    m2 += chunk_m2 + delta ** 2 * count * chunk_count / total
+    return total, mean, m2
+
+
 def main():
     parser = argparse.ArgumentParser(description="Analyze Risk Dice Simulator Output")
     parser.add_argument("-f", "--file", type=str, required=True, help="File containing the simulator output")
     parser.add_argument("--debug", action="store_true", help="Enable debug mode")
     parser.add_argument("--print-summary", action="store_true", help="Print summary statistics (default: True)")
     parser.add_argument("--print-histogram", action="store_true", help="Print the frequency histogram (default: True)")
+    parser.add_argument("--chunk-size", type=int, default=1_000_000, help="Number of lines to read at a time (default: 1000000)")
 
     args = parser.parse_args()
 
@@ -31,29 +51,50 @@ def main():
         DEBUG = True
         debug_print("Debug mode enabled")
 
+    chunks = pd.read_csv(
+        args.file,
+        header=None,
+        names=["attacker_losses", "defender_losses", "diff", "max_rolls", "non_max_rolls", "calc_time"],
+        dtype={
+            "attacker_losses": np.int32,
+            "defender_losses": np.int32,
+            "diff": np.int32,
+            "max_rolls": np.int64,
+            "non_max_rolls": np.int64,
+            "calc_time": np.float32,
+        },
+        chunksize=args.chunk_size,
+    )
+
     count = 0
-    frequency = defaultdict(int)
+    mean_diff = 0.0
+    diff_m2 = 0.0
     min_diff = max_diff = 0
-    total_diff = 0
-    total_diff_squared = 0
-
-    with open(args.file, "r") as file:
-        for line in file:
-            attacker_losses, defender_losses, diff, _max_rolls, _non_max_rolls, calc_time = map(lambda x: float(x) if '.' in x else int(x), line.strip().split(","))
-            debug_print(f"Attacker Losses: {attacker_losses}, Defender Losses: {defender_losses}, Difference: {diff}, Time: {calc_time}")
-
-            frequency[diff] += 1
-
-            count += 1
-            if count == 1:
-                min_diff = max_diff = diff
-                total_diff = diff
-                total_diff_squared = diff ** 2
-            else:
-                min_diff = min(min_diff, diff)
-                max_diff = max(max_diff, diff)
-                total_diff += diff
-                total_diff_squared += diff ** 2
+    # frequency[i] is the number of trials with a difference of min_diff + i.
+    frequency = np.zeros(0, np.int64)
+
+    for data in chunks:
+        if DEBUG:
+            for row in data.itertuples(index=False):
+                debug_print(f"Attacker Losses: {row.attacker_losses}, Defender Losses: {row.defender_losses}, Difference: {row.diff}, Time: {row.calc_time:.2f}")
+
+        diffs = data["diff"].to_numpy()
+        if diffs.size == 0:
+            continue
+
+        chunk_min, chunk_max = int(diffs.min()), int(diffs.max())
+        if count == 0:
+            new_min, new_max = chunk_min, chunk_max
+        else:
+            new_min, new_max = min(min_diff, chunk_min), max(max_diff, chunk_max)
+
+        merged = np.zeros(new_max - new_min + 1, np.int64)
+        merged[min_diff - new_min:min_diff - new_min + frequency.size] += frequency
+        merged[chunk_min - new_min:chunk_max - new_min + 1] += np.bincount(diffs - chunk_min)
+        frequency = merged
+        min_diff, max_diff = new_min, new_max
+
+        count, mean_diff, diff_m2 = update_statistics(count, mean_diff, diff_m2, diffs)
 
     if count > 0:
         if not args.print_summary and not args.print_histogram:
@@ -61,19 +102,17 @@ def main():
             args.print_histogram = True
 
         if args.print_summary:
-            average_diff = total_diff / count
-            variance = (total_diff_squared / count) - (average_diff ** 2)
-            std_dev = variance ** 0.5
+            std_dev = (diff_m2 / count) ** 0.5
 
             print(f"Total Trials: {count}")
-            print(f"Average Difference: {-average_diff:.2f}")
+            print(f"Average Difference: {-mean_diff:.2f}")
             print(f"Standard Deviation: {std_dev:.2f}")
             print(f"Range: {max_diff} to {min_diff}")
 
         if args.print_histogram:
             print("Difference,Frequency")
-            for diff, freq in sorted(frequency.items(), key=lambda x: x[0]):
-                print(f"{diff},{freq}")
+            for i in np.flatnonzero(frequency):
+                print(f"{min_diff + i},{frequency[i]}")
     else:
         print("No data to analyze.")
 
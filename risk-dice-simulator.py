@@ -5,19 +5,50 @@ Risk dice simulator
 Written by The Static Mage
 https://github.com/thestaticmage/risk-dice-analysis
 
-Parallelize the simulation:
-num_cores="24"
-seq "$num_cores" | xargs -I{} -P "$num_cores" ./risk-dice-simulator.py -a ### -d ### -t ### -c -o "output{}.txt"
+Trials are run in parallel on all cores. To limit the number of threads used
+by the Numba battle loop:
+NUMBA_NUM_THREADS=8 ./risk-dice-simulator.py -a ### -d ### -t ### -c -o output.txt
 """
 
 import argparse
+import os
 import random
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numba import njit, prange
+
+try:
+    # Optional ahead-of-time compiled battle loop (see setup.py). It runs each
+    # batch of battles on a single core, so it is only used with --cython.
+    import _sim
+except ImportError:
+    _sim = None
+
+try:
+    # Optional C battle loop (see setup.py), which simulates a whole batch of
+    # battles per call without holding the GIL.
+    import _riskcore
+except ImportError:
+    _riskcore = None
 
 DEBUG = False
-PRECOMPUTED_ROLLS = []
+BATTLE_LOOP = None
+RNG = np.random.default_rng()
+PRECOMPUTED_ROLLS = {}
+PRECOMPUTED_BITS = {}
+PRECOMPUTED_OFFSETS = np.zeros((4, 4), np.int64)
+PRECOMPUTED_LOSSES = np.empty(0, np.uint8)
 MAX_ATTACKERS = 3
 MAX_DEFENDERS = 2
+BATCH_SIZE = 100_000
+SEED_BLOCK_SIZE = 4096
+OUTPUT_BUFFER_SIZE = 1 << 20
+SPLITMIX64_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+SPLITMIX64_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+SPLITMIX64_MIX2 = np.uint64(0x94D049BB133111EB)
 HEADER = "Attacker Losses,Defender Losses,Difference,Max Rolls,Non-Max Rolls,Elapsed Time"
 
 def main():
@@ -31,6 +62,9 @@ def main():
     parser.add_argument("--header", action="store_true", help="Print header in output file")
     parser.add_argument("--debug", action="store_true", help="Enable debug mode")
     parser.add_argument("--no-precomputed-rolls", action="store_true", help="Do not use any precomputed dice rolls (runs slower)")
+    parser.add_argument("--analyze", action="store_true", help="Output the same summary and histogram as analyze-simulator-output.py instead of each trial")
+    parser.add_argument("--exact", action="store_true", help="Calculate the exact distribution of outcomes instead of simulating trials")
+    parser.add_argument("--cython", action="store_true", help="Use the single-threaded Cython battle loop from _sim.pyx (see setup.py)")
 
     args = parser.parse_args()
 
@@ -44,11 +78,25 @@ def main():
         MAX_DEFENDERS = 3
         debug_print("Capital battle mode enabled")
 
-    if not args.no_precomputed_rolls:
-        precompute_max_dice_rolls()
+    if not args.no_precomputed_rolls or args.exact:
+        precompute_dice_rolls()
 
     if args.random_seed != 0:
+        global RNG
         random.seed(args.random_seed)
+        RNG = np.random.default_rng(args.random_seed)
+    if args.cython and not _sim:
+        parser.error("--cython requires the _sim extension; build it with: python setup.py build_ext --inplace")
+
+    global BATTLE_LOOP
+    if DEBUG or args.no_precomputed_rolls:
+        BATTLE_LOOP = simulate_battles_python
+    elif args.cython:
+        BATTLE_LOOP = simulate_battles_cython
+    elif _riskcore:
+        BATTLE_LOOP = simulate_battles_riskcore
+    else:
+        BATTLE_LOOP = simulate_battles_numba
 
     debug_print(f"Attacking Troops: {args.attacking_troops}")
     debug_print(f"Defending Troops: {args.defending_troops}")
@@ -57,31 +105,108 @@ def main():
     debug_print(f"Random Seed: {args.random_seed}")
 
     if args.output_file:
-        output = open(args.output_file, "w")
-        if args.header:
+        output = open(args.output_file, "w", buffering=OUTPUT_BUFFER_SIZE)
+        if args.header and not args.analyze and not args.exact:
             output.write(HEADER + "\n")
     else:
         output = None
-        if args.header:
+        if args.header and not args.analyze and not args.exact:
             print(HEADER)
 
-    for trial in range(args.trials):
-        total_attacker_losses, total_defender_losses, max_rolls, non_max_rolls, elapsed_time = simulate_battle(args.attacking_troops, args.defending_troops)
-        diff = total_defender_losses - total_attacker_losses
-        debug_print(f"Trial {trial + 1}: Attacker Losses: {total_attacker_losses}; Defender Losses: {total_defender_losses}; Difference: {diff}")
-
-        result = f"{total_attacker_losses},{total_defender_losses},{diff},{max_rolls},{non_max_rolls},{elapsed_time:.2f}"
+    if args.exact:
+        for line in exact_analysis(args.attacking_troops, args.defending_troops):
+            if output:
+                output.write(line + "\n")
+            else:
+                print(line)
         if output:
-            output.write(result + "\n")
+            output.close()
+        return
+
+    # The attacker loses at most all but one troop, so the lowest possible
+    # difference is min_diff and frequency[i] counts differences of min_diff + i.
+    # Negative troop counts never fight, so they cannot lose any troops.
+    min_diff = -max(args.attacking_troops - 1, 0)
+    frequency = np.zeros(max(args.defending_troops, 0) - min_diff + 1, np.int64)
+
+    # Timing each battle individually costs about as much as simulating a
+    # small battle, so battles are timed in batches and each one is reported
+    # with the average time for its batch. Nothing is timed with --analyze,
+    # which does not report the time. One untimed battle first loads the
+    # compiled battle loop so that cost is not charged to the first batch.
+    if not DEBUG and args.trials > 0:
+        simulate_battles(1, args.attacking_troops, args.defending_troops)
+
+    for batch_start in range(0, args.trials, BATCH_SIZE):
+        batch_trials = min(BATCH_SIZE, args.trials - batch_start)
+        if not args.analyze:
+            start_time = time.perf_counter_ns()
+        battles = simulate_battles(batch_trials, args.attacking_troops, args.defending_troops)
+        if not args.analyze:
+            elapsed_time = (time.perf_counter_ns() - start_time) / 1e6 / batch_trials
+
+        if DEBUG:
+            for trial, (total_attacker_losses, total_defender_losses, _, _) in enumerate(battles.tolist(), batch_start):
+                debug_print(f"Trial {trial + 1}: Attacker Losses: {total_attacker_losses}; Defender Losses: {total_defender_losses}; Difference: {total_defender_losses - total_attacker_losses}")
+
+        if args.analyze:
+            frequency += np.bincount(battles[:, 1] - battles[:, 0] - min_diff, minlength=frequency.size)
+            continue
+
+        battles = battles.tolist()
+
+        # Format and write each batch in one go rather than line by line.
+        elapsed_text = f"{elapsed_time:.6f}"
+        results = "".join(f"{total_attacker_losses},{total_defender_losses},{total_defender_losses - total_attacker_losses},{max_rolls},{non_max_rolls},{elapsed_text}\n"
+                          for total_attacker_losses, total_defender_losses, max_rolls, non_max_rolls in battles)
+        if output:
+            output.write(results)
         else:
-            print(result)
+            sys.stdout.write(results)
+
+    if args.analyze:
+        for line in analysis(frequency, min_diff):
+            if output:
+                output.write(line + "\n")
+            else:
+                print(line)
 
     if output:
         output.close()
         debug_print(f"Results saved to {args.output_file}")
 
 
+def analysis(frequency, min_diff):
+    """
+    Produce the lines that analyze-simulator-output.py prints for the same
+    trials, given the number of trials with each difference. The mean and
+    standard deviation are computed exactly from the histogram.
+    """
+    count = frequency.sum()
+    if count == 0:
+        return ["No data to analyze."]
+
+    diffs = np.arange(min_diff, min_diff + frequency.size)
+    mean_diff = (diffs * frequency).sum() / count
+    std_dev = ((np.square(diffs - mean_diff) * frequency).sum() / count) ** 0.5
+    observed = np.flatnonzero(frequency)
+
+    lines = [
+        f"Total Trials: {count}",
+        f"Average Difference: {-mean_diff:.2f}",
+        f"Standard Deviation: {std_dev:.2f}",
+        f"Range: {min_diff + observed[-1]} to {min_diff + observed[0]}",
+        "Difference,Frequency",
+    ]
+    lines.extend(f"{min_diff + i},{frequency[i]}" for i in observed)
+    return lines
+
+
 def debug_print(message):
+    """
+    Print a message in debug mode. The message is formatted even when debug
+    mode is off, so calls inside loops should be guarded with "if DEBUG:".
+    """
     if DEBUG:
         print(message)
 
@@ -104,29 +229,91 @@ def calculate_losses(attacker_rolls, defender_rolls):
     return attacker_losses, defender_losses
 
 
-def precompute_max_dice_rolls():
+@njit(cache=True)
+def _sort3(x, y, z):
+    """
+    Sort three values into descending order without a general purpose sort.
+    """
+    hi = max(x, y, z)
+    lo = min(x, y, z)
+    return hi, x + y + z - hi - lo, lo
+
+
+@njit(cache=True)
+def _losses3v3(a1, a2, a3, d1, d2, d3, comparisons):
+    """
+    Calculate the attacker and defender losses for up to three dice on each
+    side, without sorting lists, for filling the precomputed tables. Dice that were not rolled are passed as 0 so that they sort last, and
+    comparisons is the number of dice pairs that are compared (the smaller of
+    the number of attacker and defender dice).
+    """
+    a_hi, a_med, a_lo = _sort3(a1, a2, a3)
+    d_hi, d_med, d_lo = _sort3(d1, d2, d3)
+
+    defender_losses = int(a_hi > d_hi) + int(a_med > d_med) * int(comparisons > 1) + int(a_lo > d_lo) * int(comparisons > 2)
+    return comparisons - defender_losses, defender_losses
+
+
+def precompute_dice_rolls():
     """
-    Precomputing the maximum dice rolls cuts the execution time by an order of
+    Precomputing the dice rolls cuts the execution time by an order of
     magnitude. That's because for future iterations we only need to pick one
-    random number instead of 5 or 6.
+    random number instead of 2 to 6.
+
+    The losses for every combination of attacker and defender dice are stored
+    back to back in PRECOMPUTED_LOSSES, with PRECOMPUTED_OFFSETS[attackers,
+    defenders] giving the start of the 6**(attackers+defenders) outcomes for
+    that combination. PRECOMPUTED_ROLLS maps (attackers, defenders) to views of
+    the same outcomes, and PRECOMPUTED_BITS to the number of random bits needed
+    to index them. Each outcome is packed into one byte, with the attacker
+    losses in the high nibble and the defender losses in the low nibble, so the
+    whole table fits in L2 cache.
     """
 
-    global PRECOMPUTED_ROLLS
+    global PRECOMPUTED_LOSSES
     start_time = time.time()
-    for a1 in range(1, 7):
-        for a2 in range(1, 7):
-            for a3 in range(1, 7):
-                for d1 in range(1, 7):
-                    for d2 in range(1, 7):
-                        if MAX_DEFENDERS == 3:
-                            for d3 in range(1, 7):
-                                attacker_losses, defender_losses = calculate_losses([a1, a2, a3], [d1, d2, d3])
-                                PRECOMPUTED_ROLLS.append((attacker_losses, defender_losses))
-                        else:
-                            attacker_losses, defender_losses = calculate_losses([a1, a2, a3], [d1, d2])
-                            PRECOMPUTED_ROLLS.append((attacker_losses, defender_losses))
-
-    debug_print(f"Precomputed {len(PRECOMPUTED_ROLLS)} maximum dice rolls in {time.time() - start_time:.5f} seconds")
+    total_outcomes = sum(6 ** (attackers + defenders) for attackers in range(1, MAX_ATTACKERS + 1) for defenders in range(1, MAX_DEFENDERS + 1))
+    PRECOMPUTED_LOSSES = np.empty(total_outcomes, np.uint8)
+
+    offset = 0
+    for attackers in range(1, MAX_ATTACKERS + 1):
+        for defenders in range(1, MAX_DEFENDERS + 1):
+            PRECOMPUTED_OFFSETS[attackers, defenders] = offset
+            offset += 6 ** (attackers + defenders)
+
+    for attackers in range(1, MAX_ATTACKERS + 1):
+        for defenders in range(1, MAX_DEFENDERS + 1):
+            start = PRECOMPUTED_OFFSETS[attackers, defenders]
+            end = start + 6 ** (attackers + defenders)
+            PRECOMPUTED_ROLLS[(attackers, defenders)] = PRECOMPUTED_LOSSES[start:end]
+            _fill_losses(attackers, defenders, PRECOMPUTED_ROLLS[(attackers, defenders)])
+            PRECOMPUTED_BITS[(attackers, defenders)] = (6 ** (attackers + defenders)).bit_length()
+
+    debug_print(f"Precomputed {PRECOMPUTED_LOSSES.size} dice rolls in {time.time() - start_time:.5f} seconds")
+
+
+@njit(cache=True)
+def _fill_losses(attackers, defenders, losses):
+    """
+    Fill losses with the packed attacker and defender losses for every one of
+    the 6**(attackers+defenders) possible rolls, treating the index as the dice
+    values written in base 6.
+    """
+    dice = np.zeros(6, np.int64)
+    for i in range(losses.size):
+        rolls = i
+        for j in range(attackers + defenders):
+            dice[j] = rolls % 6 + 1
+            rolls //= 6
+        # Pad both sides to three dice with zeros, which sort last.
+        a1 = dice[0]
+        a2 = dice[1] if attackers > 1 else 0
+        a3 = dice[2] if attackers > 2 else 0
+        d1 = dice[attackers]
+        d2 = dice[attackers + 1] if defenders > 1 else 0
+        d3 = dice[attackers + 2] if defenders > 2 else 0
+        attacker_losses, defender_losses = _losses3v3(a1, a2, a3, d1, d2, d3, min(attackers, defenders))
+        losses[i] = (attacker_losses << 4) | defender_losses
 
 
 def roll_one_die():
@@ -152,28 +339,176 @@ def roll_dice(attacking_troops: int, defending_troops: int):
     defenders = min(defending_troops, MAX_DEFENDERS)
     is_max_roll = attackers >= MAX_ATTACKERS and defenders >= MAX_DEFENDERS
 
-    if len(PRECOMPUTED_ROLLS) > 0 and is_max_roll:
-        attacker_losses, defender_losses = PRECOMPUTED_ROLLS[random.randint(0, len(PRECOMPUTED_ROLLS)-1)]
-        debug_print(f"[pre-computed] Losses: {attacker_losses},{defender_losses}; Troops: {attacking_troops-attacker_losses},{defending_troops-defender_losses}")
+    if len(PRECOMPUTED_ROLLS) > 0:
+        precomputed_losses = PRECOMPUTED_ROLLS[(attackers, defenders)]
+        # Rejection sampling with getrandbits() skips the extra Python-level
+        # work that randrange() does on every call.
+        outcomes = precomputed_losses.size
+        bits = PRECOMPUTED_BITS[(attackers, defenders)]
+        getrandbits = random.getrandbits
+        i = getrandbits(bits)
+        while i >= outcomes:
+            i = getrandbits(bits)
+        outcome = int(precomputed_losses[i])
+        attacker_losses, defender_losses = outcome >> 4, outcome & 0xF
+        if DEBUG:
+            debug_print(f"[pre-computed] Losses: {attacker_losses},{defender_losses}; Troops: {attacking_troops-attacker_losses},{defending_troops-defender_losses}")
         return attacker_losses, defender_losses, is_max_roll
 
     attacker_rolls = [roll_one_die() for _ in range(attackers)]
     defender_rolls = [roll_one_die() for _ in range(defenders)]
     attacker_losses, defender_losses = calculate_losses(attacker_rolls, defender_rolls)
-    debug_print(f"[simulated] Attacker: {attacker_rolls}; Defender: {defender_rolls}; Losses: {attacker_losses},{defender_losses}; Troops: {attacking_troops-attacker_losses},{defending_troops-defender_losses}")
+    if DEBUG:
+        debug_print(f"[simulated] Attacker: {attacker_rolls}; Defender: {defender_rolls}; Losses: {attacker_losses},{defender_losses}; Troops: {attacking_troops-attacker_losses},{defending_troops-defender_losses}")
 
     return attacker_losses, defender_losses, is_max_roll
 
 
+def exact_analysis(attacking_troops: int, defending_troops: int):
+    """
+    Calculate the exact distribution of the difference between defender and
+    attacker losses, and produce lines in the same style as analysis().
+
+    A battle is an absorbing Markov chain on (attacking troops, defending
+    troops), with the transition probabilities taken from the precomputed
+    rolls. Every roll removes at least one troop, so the chain has no cycles
+    and the absorption probabilities can be found by pushing probability
+    forward through the states in order, rather than by solving (I-Q)^-1 R.
+    """
+    transitions = np.zeros((MAX_ATTACKERS + 1, 4, 4, 4))
+    for (attackers, defenders), losses in PRECOMPUTED_ROLLS.items():
+        outcomes = np.bincount(losses, minlength=64) / losses.size
+        transitions[attackers, defenders] = outcomes.reshape(4, 16)[:, :4]
+
+    attacking_troops = max(attacking_troops, 1)
+    defending_troops = max(defending_troops, 0)
+    probability = _absorption_probabilities(attacking_troops, defending_troops, MAX_DEFENDERS, transitions)
+
+    # Only one of these is non-zero for each difference, since the battle ends
+    # with the attacker down to one troop or the defender down to none.
+    min_diff = 1 - attacking_troops
+    diff_probability = np.zeros(defending_troops - min_diff + 1)
+    for remaining_attackers in range(2, attacking_troops + 1):
+        diff_probability[defending_troops - (attacking_troops - remaining_attackers) - min_diff] += probability[remaining_attackers, 0]
+    for remaining_defenders in range(defending_troops + 1):
+        diff_probability[(defending_troops - remaining_defenders) - (attacking_troops - 1) - min_diff] += probability[1, remaining_defenders]
+
+    diffs = np.arange(min_diff, min_diff + diff_probability.size)
+    mean_diff = (diffs * diff_probability).sum()
+    std_dev = ((np.square(diffs - mean_diff) * diff_probability).sum()) ** 0.5
+    possible = np.flatnonzero(diff_probability)
+
+    lines = [
+        f"Average Difference: {-mean_diff:.2f}",
+        f"Standard Deviation: {std_dev:.2f}",
+        f"Range: {min_diff + possible[-1]} to {min_diff + possible[0]}",
+        "Difference,Probability",
+    ]
+    lines.extend(f"{min_diff + i},{diff_probability[i]:.10g}" for i in possible)
+    return lines
+
+
+@njit(cache=True)
+def _absorption_probabilities(attacking_troops, defending_troops, max_defenders, transitions):
+    """
+    Return the probability of the battle passing through each (attacking
+    troops, defending troops) state. For the absorbing states, where the
+    attacker has one troop or the defender has none, this is the probability
+    of the battle ending there. transitions[attackers, defenders,
+    attacker_losses, defender_losses] is the probability of each outcome of a
+    single roll.
+    """
+    probability = np.zeros((attacking_troops + 1, defending_troops + 1))
+    probability[attacking_troops, defending_troops] = 1.0
+
+    # Every predecessor of a state has at least as many troops on both sides,
+    # so visiting states from the most troops down sees each one only after all
+    # of its predecessors.
+    for a in range(attacking_troops, 1, -1):
+        for d in range(defending_troops, 0, -1):
+            p = probability[a, d]
+            if p == 0.0:
+                continue
+            attackers = min(a - 1, MAX_ATTACKERS)
+            defenders = min(d, max_defenders)
+            for attacker_losses in range(min(attackers, defenders) + 1):
+                defender_losses = min(attackers, defenders) - attacker_losses
+                probability[a - attacker_losses, d - defender_losses] += p * transitions[attackers, defenders, attacker_losses, defender_losses]
+
+    return probability
+
+
+def simulate_battles(trials: int, attacking_troops: int, defending_troops: int):
+    """
+    Simulate a number of independent battles with the battle loop chosen in
+    main().
+
+    Returns an array with one [attacker losses, defender losses, number of
+    maximum rolls, number of non-maximum rolls] row per battle.
+    """
+    return BATTLE_LOOP(trials, attacking_troops, defending_troops)
+
+
+def simulate_battles_python(trials: int, attacking_troops: int, defending_troops: int):
+    """
+    Simulate battles one at a time in Python. The compiled battle loops cannot
+    print and only work from the precomputed rolls, so this is used in debug
+    mode and with --no-precomputed-rolls.
+    """
+    return np.array([simulate_battle(attacking_troops, defending_troops) for _ in range(trials)], np.int64).reshape(trials, 4)
+
+
+def simulate_battles_numba(trials: int, attacking_troops: int, defending_troops: int):
+    """
+    Simulate battles in parallel with the Numba battle loop, on
+    NUMBA_NUM_THREADS threads.
+    """
+    battles = np.empty((trials, 4), np.int64)
+    seeds = RNG.integers(0, 2**64, trials, dtype=np.uint64)
+    _simulate_battles(attacking_troops, defending_troops, MAX_DEFENDERS, PRECOMPUTED_OFFSETS, PRECOMPUTED_LOSSES, seeds, battles)
+    return battles
+
+
+def simulate_battles_riskcore(trials: int, attacking_troops: int, defending_troops: int):
+    """
+    Simulate battles in parallel on all cores with the C battle loop from
+    _riskcore.c.
+    """
+    # simulate_batch() releases the GIL, so blocks of battles run on separate
+    # cores. Every block of SEED_BLOCK_SIZE battles has its own seed, so the
+    # results for a given --random-seed do not depend on the number of cores.
+    battles = np.empty((trials, 4), np.int64)
+    starts = range(0, trials, SEED_BLOCK_SIZE)
+    seeds = RNG.integers(0, 2**64, len(starts), dtype=np.uint64)
+    with ThreadPoolExecutor(os.cpu_count()) as executor:
+        list(executor.map(lambda start, seed: _riskcore.simulate_batch(attacking_troops, defending_troops, MAX_DEFENDERS, PRECOMPUTED_OFFSETS,
+                                                                       PRECOMPUTED_LOSSES, int(seed), battles[start:start + SEED_BLOCK_SIZE]),
+                          starts, seeds))
+    return battles
+
+
+def simulate_battles_cython(trials: int, attacking_troops: int, defending_troops: int):
+    """
+    Simulate battles on a single core with the Cython battle loop from
+    _sim.pyx.
+    """
+    battles = np.empty((trials, 4), np.int64)
+    _sim.simulate_batch(attacking_troops, defending_troops, MAX_DEFENDERS, PRECOMPUTED_OFFSETS, PRECOMPUTED_LOSSES,
+                        int(RNG.integers(0, 2**64, dtype=np.uint64)), battles)
+    return battles
+
+
 def simulate_battle(attacking_troops: int, defending_troops: int):
     """
     Simulate a complete battle between attacking and defending troops until one
-    side is eliminated.
+    side is eliminated, logging each roll via roll_dice().
+
+    Returns the attacker losses, defender losses, number of maximum rolls and
+    number of non-maximum rolls.
     """
     total_attacker_losses = 0
     total_defender_losses = 0
 
-    start_time = time.time()
     non_maximum_rolls = 0
     maximum_rolls = 0
 
@@ -190,7 +525,95 @@ def simulate_battle(attacking_troops: int, defending_troops: int):
         attacking_troops -= attacker_losses
         defending_troops -= defender_losses
 
-    return total_attacker_losses, total_defender_losses, maximum_rolls, non_maximum_rolls, 1000*(time.time() - start_time)
+    return total_attacker_losses, total_defender_losses, maximum_rolls, non_maximum_rolls
+
+
+@njit(cache=True)
+def _random_state(seed):
+    """
+    Create the state for _next_random(), expanding the seed with SplitMix64 as
+    recommended by the xoshiro authors.
+    """
+    state = np.empty(4, np.uint64)
+    for i in range(4):
+        seed += SPLITMIX64_GAMMA
+        z = seed
+        z = (z ^ (z >> np.uint64(30))) * SPLITMIX64_MIX1
+        z = (z ^ (z >> np.uint64(27))) * SPLITMIX64_MIX2
+        state[i] = z ^ (z >> np.uint64(31))
+    return state
+
+
+@njit(cache=True)
+def _rotl(x, k):
+    return (x << np.uint64(k)) | (x >> np.uint64(64 - k))
+
+
+@njit(cache=True)
+def _next_random(state):
+    """
+    xoshiro256** by David Blackman and Sebastiano Vigna. Each battle gets its
+    own state, so battles can be simulated on different threads. The compiled
+    extensions use the same generator from _xoshiro.h.
+    """
+    result = _rotl(state[1] * np.uint64(5), 7) * np.uint64(9)
+    t = state[1] << np.uint64(17)
+    state[2] ^= state[0]
+    state[3] ^= state[1]
+    state[1] ^= state[2]
+    state[0] ^= state[3]
+    state[2] ^= t
+    state[3] = _rotl(state[3], 45)
+    return result
+
+
+@njit(cache=True)
+def _simulate_battle(attacking_troops, defending_troops, max_defenders, precomp_offsets, precomp_losses, state):
+    """
+    Compiled version of the battle loop. precomp_offsets and precomp_losses are
+    the tables built by precompute_dice_rolls(), so every roll is a single
+    random index into them, drawn with _next_random(state).
+
+    Returns the attacker losses, defender losses, number of maximum rolls and
+    number of non-maximum rolls.
+    """
+    initial_attacking_troops = attacking_troops
+    initial_defending_troops = defending_troops
+    maximum_rolls = 0
+    non_maximum_rolls = 0
+
+    while attacking_troops > 1 and defending_troops > 0:
+        attackers = min(attacking_troops - 1, MAX_ATTACKERS)
+        defenders = min(defending_troops, max_defenders)
+        outcomes = 6 ** (attackers + defenders)
+
+        # The modulo bias is at most 6**6 / 2**64, far below anything the
+        # simulation could detect.
+        i = precomp_offsets[attackers, defenders] + np.int64(_next_random(state) % np.uint64(outcomes))
+        attacking_troops -= precomp_losses[i] >> 4
+        defending_troops -= precomp_losses[i] & 0xF
+
+        if attackers >= MAX_ATTACKERS and defenders >= max_defenders:
+            maximum_rolls += 1
+        else:
+            non_maximum_rolls += 1
+
+    total_attacker_losses = initial_attacking_troops - attacking_troops
+    total_defender_losses = initial_defending_troops - defending_troops
+
+    return total_attacker_losses, total_defender_losses, maximum_rolls, non_maximum_rolls
+
+
+@njit(parallel=True, cache=True)
+def _simulate_battles(attacking_troops, defending_troops, max_defenders, precomp_offsets, precomp_losses, seeds, battles):
+    """
+    Simulate one battle per seed on all available threads, storing the results
+    of _simulate_battle() in the rows of battles.
+    """
+    for trial in prange(seeds.size):
+        state = _random_state(seeds[trial])
+        battles[trial, 0], battles[trial, 1], battles[trial, 2], battles[trial, 3] = _simulate_battle(
+            attacking_troops, defending_troops, max_defenders, precomp_offsets, precomp_losses, state)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,14 @@
+"""
+Builds the optional compiled battle loops used by risk-dice-simulator.py:
+python setup.py build_ext --inplace
+"""
+
+from Cython.Build import cythonize
+from setuptools import Extension, setup
+
+setup(
+    name="risk-dice-analysis",
+    ext_modules=cythonize([Extension("_sim", ["_sim.pyx"], depends=["_xoshiro.h"])]) + [
+        Extension("_riskcore", ["_riskcore.c"], depends=["_xoshiro.h"], extra_compile_args=["-O3"]),
+    ],
+)